@@ -6,7 +6,7 @@ usage: neoepitopeprediction.py [-h]
                                 [-v VCF] [-t {VEP,ANNOVAR,SNPEFF}] [-p PROTEINS]
                                 [-minl, -maxl {8,9,10,11,12,13,14,15,16,17}]
                                 -a ALLELES
-                                [-r REFERENCE] [-fINDEL] [-fFS] [-fSNP]
+                                [-r REFERENCE] [-fINDEL] [-fFS] [-fSNP] [-pass]
                                 -o OUTPUT
 Neoepitope prediction for TargetInsepctor.
 optional arguments:
@@ -34,6 +34,7 @@ optional arguments:
     -fFS, --filterFSINDEL
                         Filter frameshift INDELs
     -fSNP, --filterSNP    Filter SNPs
+    -pass, --pass_only    Only consider VEP variants that passed all filters
     -bind, --predict_bindings
                         Whether to predict bindings or not
     -o OUTPUT, --output OUTPUT
@@ -47,8 +48,19 @@ and insertions should be considered in addition to single nucleotide variations
 currently supports ANNOVAR [19] and Variant Effect Predictor [20] annotations for GRCh37 and GRCh38 only.
 """
 import sys
+import bisect
+import csv
+import re
 import argparse
+import itertools
 import logging
+import numpy as np
+
+from collections import OrderedDict
+try:
+    from sys import intern
+except ImportError:  # Python 2, intern is a builtin
+    pass
 
 from Fred2.Core import Protein, Allele, MutationSyntax, Variant
 from Fred2.Core.Variant import VariationType
@@ -69,38 +81,85 @@ LOG.setLevel(logging.INFO)
 MARTDBURL = {"GRCH37": "http://grch37.ensembl.org/biomart/martservice?query=",
                 "GRCH38": "http://www.ensembl.org/biomart/martservice?query="}  # is correctly set to GRCh38
 
+# consequence terms that directly influence the protein sequence, matched as whole words
+# within the "&"-separated consequence field
+CODING_TYPES = ["3_prime_UTR_variant", "5_prime_UTR_variant", "start_lost", "stop_gained", "frameshift_variant",
+                "inframe_insertion", "inframe_deletion", "missense_variant", "protein_altering_variant",
+                "splice_region_variant", "incomplete_terminal_codon_variant", "stop_retained_variant",
+                "synonymous_variant", "coding_sequence_variant"]
+CODING_RE = re.compile(r"\b(?:" + "|".join(re.escape(t) for t in CODING_TYPES) + r")\b")
+SYN_STR = "synonymous_variant"
+
+# number of malformed INFO fields that are reported individually
+MAX_FORMAT_WARNINGS = 100
+
+# FILTER values of records that passed all filters or were not filtered at all
+PASSING_FILTERS = frozenset(["PASS", ".", ""])
 
-def read_variant_effect_predictor(file, gene_filter=None):
+
+def get_type(ref, alt):
+    """
+        returns the variant type
+    """
+    if len(ref) == 1 and len(alt) == 1:
+        return VariationType.SNP
+    if len(ref) > 0 and len(alt) == 0:
+        if len(ref) % 3 == 0:
+            return VariationType.DEL
+        else:
+            return VariationType.FSDEL
+    if len(ref) == 0 and len(alt) > 0:
+        if len(alt) % 3 == 0:
+            return VariationType.INS
+        else:
+            return VariationType.FSINS
+    return VariationType.UNKNOWN
+
+
+def read_variant_effect_predictor(file, gene_filter=None, excluded_types=None, pass_only=False):
     """
     Reads a VCF (v4.1) file generated by variant effect predictor and generates variant objects
     :param str file: Path to vcf file
     :param list gene_filter: List of proteins (in HGNC) of inerrest. Variants are filter according to this list
+    :param set excluded_types: Variation types that are skipped without parsing their annotations
+    :param bool pass_only: Whether records that did not pass all filters are skipped
     :return: list(Variant) - a list of Fred2.Core.Variant objects
     """
+    gene_filter = frozenset(gene_filter) if gene_filter else None
+    excluded_types = frozenset(excluded_types) if excluded_types else frozenset()
+    records, first_malformed, n_malformed = read_vep_records(file, gene_filter, excluded_types, pass_only)
+
     vars = []
+    for chrom, gene_pos, var_id, ref, alt, var_type, is_synonymous, coding in records:
+        # positioning in Fred2 is 0-based!!!
+        coding = dict((transcript_id, MutationSyntax(transcript_id, transcript_pos, prot_pos, co, "", geneID=gene))
+                      for transcript_id, (transcript_pos, prot_pos, co, gene) in coding.items())
+        vars.append(Variant(var_id, var_type, chrom, gene_pos, ref.upper(), alt.upper(), coding, False,
+                            is_synonymous))
+
+    for i in first_malformed:
+        LOG.warning("INFO field in different format in line: %d, skipping...", i)
+    if n_malformed > len(first_malformed):
+        LOG.warning("%d more INFO fields in different format, skipping...", n_malformed - len(first_malformed))
 
-    def get_type(ref, alt):
-        """
-            returns the variant type
-        """
-        if len(ref) == 1 and len(alt) == 1:
-            return VariationType.SNP
-        if len(ref) > 0 and len(alt) == 0:
-            if len(ref) % 3 == 0:
-                return VariationType.DEL
-            else:
-                return VariationType.FSDEL
-        if len(ref) == 0 and len(alt) > 0:
-            if len(alt) % 3 == 0:
-                return VariationType.INS
-            else:
-                return VariationType.FSINS
-        return VariationType.UNKNOWN
-
-    coding_types = {"3_prime_UTR_variant", "5_prime_UTR_variant", "start_lost", "stop_gained", "frameshift_variant",
-                    "start_lost", "inframe_insertion", "inframe_deletion", "missense_variant",
-                    "protein_altering_variant", "splice_region_variant", "incomplete_terminal_codon_variant",
-                    "stop_retained_variant", "synonymous_variant", "coding_sequence_variant"}
+    return vars
+
+
+def read_vep_records(file, gene_filter=None, excluded_types=frozenset(), pass_only=False):
+    """
+    Parses the records of a VCF file generated by variant effect predictor
+    :param str file: Path to vcf file
+    :param frozenset gene_filter: Set of proteins (in HGNC) of interest, None to keep all variants
+    :param frozenset excluded_types: Variation types that are skipped without parsing their annotations
+    :param bool pass_only: Whether records that did not pass all filters are skipped
+    :return: (list(tuple), list(int), int) - the fields of all records with coding annotations, the line numbers
+             of the first MAX_FORMAT_WARNINGS malformed INFO fields and the number of malformed INFO fields
+    """
+    records = []
+    first_malformed = []
+    n_malformed = 0
+    # consequences are drawn from a small vocabulary, so every distinct value is only classified once
+    consequences = {}
 
     with open(file, "r") as f:
         for i, l in enumerate(f):
@@ -109,40 +168,111 @@ def read_variant_effect_predictor(file, gene_filter=None):
             if l.startswith("#") or l.strip() == "":
                 continue
 
-            chrom, gene_pos, var_id, ref, alt, _, filter_flag, info = l.strip().split("\t")[:8]
+            chrom, gene_pos, var_id, ref, alt, _, filter_flag, info = l.strip().split("\t", 8)[:8]
+            if pass_only and filter_flag not in PASSING_FILTERS:
+                continue
+            var_type = get_type(ref, alt)
+            if var_type in excluded_types:
+                continue
+
             coding = {}
             is_synonymous = False
 
             for co in info.split(","):
+                # Allele|Consequence|IMPACT|SYMBOL|Gene|Feature_type|Feature|BIOTYPE|EXON|INTRON|HGVSc|HGVSp|cDNA_position|CDS_position|Protein_position|Amino_acids|Codons|Existing_variation|DISTANCE|STRAND|FLAGS|SYMBOL_SOURCE|HGNC_ID|TSL|APPRIS|SIFT|PolyPhen|AF|AFR_AF|AMR_AF|EAS_AF|EUR_AF|SAS_AF|AA_AF|EA_AF|gnomAD_AF|gnomAD_AFR_AF|gnomAD_AMR_AF|gnomAD_ASJ_AF|gnomAD_EAS_AF|gnomAD_FIN_AF|gnomAD_NFE_AF|gnomAD_OTH_AF|gnomAD_SAS_AF|CLIN_SIG|SOMATIC|PHENO|PUBMED|MOTIF_NAME|MOTIF_POS|HIGH_INF_POS|MOTIF_SCORE_CHANGE">
+                fields = co.split("|", 16)
                 # skip additional info fields without annotation
-                try:
-                    # Allele|Consequence|IMPACT|SYMBOL|Gene|Feature_type|Feature|BIOTYPE|EXON|INTRON|HGVSc|HGVSp|cDNA_position|CDS_position|Protein_position|Amino_acids|Codons|Existing_variation|DISTANCE|STRAND|FLAGS|SYMBOL_SOURCE|HGNC_ID|TSL|APPRIS|SIFT|PolyPhen|AF|AFR_AF|AMR_AF|EAS_AF|EUR_AF|SAS_AF|AA_AF|EA_AF|gnomAD_AF|gnomAD_AFR_AF|gnomAD_AMR_AF|gnomAD_ASJ_AF|gnomAD_EAS_AF|gnomAD_FIN_AF|gnomAD_NFE_AF|gnomAD_OTH_AF|gnomAD_SAS_AF|CLIN_SIG|SOMATIC|PHENO|PUBMED|MOTIF_NAME|MOTIF_POS|HIGH_INF_POS|MOTIF_SCORE_CHANGE">
-                    _, var_type, _, gene, _, transcript_type, transcript_id, _, _, _, _, _, _, transcript_pos, prot_pos, aa_mutation = co.strip().split(
-                        "|")[:16]
-                except ValueError:
-                    LOG.warning("INFO field in different format in line: {}, skipping...".format(str(i)))
+                if len(fields) < 16:
+                    if n_malformed < MAX_FORMAT_WARNINGS:
+                        first_malformed.append(i)
+                    n_malformed += 1
                     continue
+                consequence = fields[1]
+                gene = fields[3]
 
                 # pass every other feature type except Transcript (RegulatoryFeature, MotifFeature.)
                 # pass genes that are uninteresting for us
-                if transcript_type != "Transcript" or (gene not in gene_filter and gene_filter):
+                if fields[5] != "Transcript":
+                    continue
+                if gene_filter is not None and gene not in gene_filter:
                     continue
 
-                # pass all intronic and other mutations that do not directly influence the protein sequence
-                if any(t in coding_types for t in var_type.split("&")):
-                    # generate mutation syntax
+                if consequence not in consequences:
+                    consequences[consequence] = (CODING_RE.search(consequence) is not None, SYN_STR in consequence)
+                is_coding, is_synonymous = consequences[consequence]
 
-                    # positioning in Fred2 is 0-based!!!
-                    if transcript_pos != "" and '?' not in transcript_pos:
-                        coding[transcript_id] = MutationSyntax(transcript_id, int(transcript_pos.split("-")[0]) - 1, -1 if prot_pos == "" else int(prot_pos.split("-")[0]) - 1, co, "", geneID=gene)
-                # is variant synonymous?
-                is_synonymous = any(t == "synonymous_variant" for t in var_type.split("&"))
+                # pass all intronic and other mutations that do not directly influence the protein sequence
+                transcript_pos = fields[13]
+                if is_coding and transcript_pos != "" and "?" not in transcript_pos:
+                    prot_pos = fields[14]
+                    # gene and transcript IDs repeat across records, keep a single copy of each
+                    transcript_id = intern(fields[6])
+                    coding[transcript_id] = (int(transcript_pos.split("-")[0]) - 1,
+                                             -1 if prot_pos == "" else int(prot_pos.split("-")[0]) - 1,
+                                             co, intern(gene))
 
             if coding:
-                vars.append(
-                    Variant(var_id, get_type(ref, alt), chrom, int(gene_pos), ref.upper(), alt.upper(), coding, False,
-                            is_synonymous))
-    return vars
+                records.append((intern(chrom), int(gene_pos), var_id, ref, alt, var_type, is_synonymous, coding))
+
+    return records, first_malformed, n_malformed
+
+
+def get_variant_peptides(proteins, min_length, max_length):
+    """
+    Collects all peptide sequences of the given length range that overlap a variant position, using a single
+    sliding window pass over each variant protein
+    :param list proteins: List of Fred2.Core.Protein objects
+    :param int min_length: The minimal length of peptides
+    :param int max_length: The maximal length of peptides
+    :return: set(str) - sequences of peptides potentially containing a variant
+    """
+    sequences = set()
+    for prot in proteins:
+        if not prot.vars:
+            continue
+        seq = str(prot)
+        positions = sorted(prot.vars)
+
+        # frameshifts alter every residue downstream of their position
+        frameshifts = [pos for pos in positions
+                       if any(v.type in (VariationType.FSDEL, VariationType.FSINS) for v in prot.vars[pos])]
+        frameshift_pos = frameshifts[0] if frameshifts else len(seq) + 1
+
+        for start in range(len(seq) - min_length + 1):
+            # first variant position at or after the window start
+            idx = bisect.bisect_left(positions, start)
+            first = positions[idx] if idx < len(positions) else len(seq) + 1
+            first = min(first, max(frameshift_pos, start))
+            # windows are treated as covering their end position as well, so the set is a superset
+            for length in range(max(min_length, first - start), min(max_length, len(seq) - start) + 1):
+                sequences.add(seq[start:start + length])
+    return sequences
+
+
+def format_peptide_variants(peptide, transcript_ids):
+    """
+    Formats the variants contained in a peptide, grouped by the protein they originate from
+    :param Peptide peptide: A Fred2.Core.Peptide object
+    :param dict transcript_ids: Cache of protein IDs to their transcript IDs (without ":FRED2" suffix)
+    :return: str - the "|"-separated variants per transcript
+    """
+    variants = set()
+    for prot_id in peptide.proteins:
+        prot_vars = peptide.get_variants_by_protein(prot_id)
+        if prot_vars:
+            if prot_id not in transcript_ids:
+                transcript_ids[prot_id] = prot_id.split(":FRED2")[0]
+            variants.add(transcript_ids[prot_id] + ":" + ",".join(repr(v) for v in set(prot_vars)))
+    return "|".join(variants)
+
+
+def tsv_writer(f):
+    """
+    Creates a csv writer for the unquoted tab separated output files
+    :param file f: The opened output file
+    :return: csv.writer
+    """
+    return csv.writer(f, delimiter="\t", lineterminator="\n", quoting=csv.QUOTE_NONE, quotechar=None)
 
 
 def main():
@@ -224,6 +354,12 @@ def main():
         help='Filter SNPs'
     )
 
+    model.add_argument(
+        '-pass', '--pass_only',
+        action="store_true",
+        help='Only consider VEP variants that passed all filters'
+    )
+
     model.add_argument(
         '-etk', '--etk',
         action="store_true",
@@ -261,26 +397,27 @@ def main():
                     l = l.strip()
                     if l != "":
                         protein_ids.append(l)
-        if args.type == "VEP":
-            variants = read_variant_effect_predictor(args.vcf, gene_filter=protein_ids)
-        elif args.type == "SNPEFF":
-            variants = read_vcf(args.vcf)[0]
-        else:
-            variants = read_annovar_exonic(args.vcf, gene_filter=protein_ids)
 
-        variants = filter(lambda x: x.type != VariationType.UNKNOWN, variants)
+        excluded_types = {VariationType.UNKNOWN}
 
         if args.filterSNP:
-            variants = filter(lambda x: x.type != VariationType.SNP, variants)
+            excluded_types.add(VariationType.SNP)
 
         if args.filterINDEL:
-            variants = filter(lambda x: x.type not in [VariationType.INS,
-                                                        VariationType.DEL,
-                                                        VariationType.FSDEL,
-                                                        VariationType.FSINS], variants)
+            excluded_types.update([VariationType.INS, VariationType.DEL, VariationType.FSDEL, VariationType.FSINS])
+        elif args.filterFSINDEL:
+            excluded_types.update([VariationType.FSDEL, VariationType.FSINS])
+
+        if args.type == "VEP":
+            variants = read_variant_effect_predictor(args.vcf, gene_filter=protein_ids,
+                                                     excluded_types=excluded_types, pass_only=args.pass_only)
+        elif args.type == "SNPEFF":
+            variants = read_vcf(args.vcf)[0]
+        else:
+            variants = read_annovar_exonic(args.vcf, gene_filter=protein_ids)
 
-        if args.filterFSINDEL:
-            variants = filter(lambda x: x.type not in [VariationType.FSDEL, VariationType.FSINS], variants)
+        # VEP records of excluded types are already skipped while reading
+        variants = [v for v in variants if v.type not in excluded_types]
 
         if not variants:
             sys.stderr.write("No variants left after filtering. Please refine your filtering criteria.\n")
@@ -290,95 +427,92 @@ def main():
         minlength=args.peptide_min_length
         maxlength=args.peptide_max_length
         prots = [p for p in generate_proteins_from_transcripts(generate_transcripts_from_variants(variants, martDB, EIdentifierTypes.ENSEMBL))]
+        candidates = get_variant_peptides(prots, minlength, maxlength)
         for peplen in range(minlength, maxlength+1):
-            peptide_gen = generate_peptides_from_proteins(prots, peplen)
-
-            peptides_var = [x for x in peptide_gen]
-
+            # an empty peptide list would disable the filtering in generate_peptides_from_proteins
+            if not candidates:
+                break
             # remove peptides which are not 'variant relevant'
-            peptides = [x for x in peptides_var if any(x.get_variants_by_protein(y) for y in x.proteins.keys())]
-            epitopes.extend(peptides)
+            epitopes.extend(x for x in generate_peptides_from_proteins(prots, peplen, peptides=candidates)
+                            if any(x.get_variants_by_protein(y) for y in x.proteins))
 
-        for v in variants:
-            for trans_id, coding in v.coding.iteritems():
-                if coding.geneID is not None:
-                    transcript_to_genes[trans_id] = coding.geneID
-                else:
-                    transcript_to_genes[trans_id] = 'None'
+        transcript_to_genes.update((trans_id, 'None' if coding.geneID is None else coding.geneID)
+                                   for v in variants for trans_id, coding in v.coding.items())
 
     # else: generate protein sequences from given HGNC IDs and then epitopes
     else:
-        proteins = []
+        # every HGNC ID and protein ID is only queried once from BioMart
         with open(args.proteins, "r") as f:
-            for l in f:
-                ensembl_ids = martDB.get_ensembl_ids_from_id(l.strip(), type=EIdentifierTypes.HGNC)[0]
-                protein_seq = martDB.get_product_sequence(ensembl_ids[EAdapterFields.PROTID])
-                if protein_seq is not None:
-                    transcript_to_genes[ensembl_ids[EAdapterFields.TRANSID]] = l.strip()
-                    proteins.append(
-                        Protein(protein_seq, gene_id=l.strip(), transcript_id=ensembl_ids[EAdapterFields.TRANSID]))
-        epitopes = []
-        for length in range(args.peptide_min_length, args.peptide_max_length):
-            epitopes.extend(generate_peptides_from_proteins(proteins, length))
+            hgnc_ids = list(OrderedDict.fromkeys(l.strip() for l in f if l.strip() != ""))
+
+        proteins = []
+        product_sequences = {}
+        for hgnc_id in hgnc_ids:
+            ensembl_ids = martDB.get_ensembl_ids_from_id(hgnc_id, type=EIdentifierTypes.HGNC)[0]
+            prot_id = ensembl_ids[EAdapterFields.PROTID]
+            if prot_id not in product_sequences:
+                product_sequences[prot_id] = martDB.get_product_sequence(prot_id)
+            protein_seq = product_sequences[prot_id]
+            if protein_seq is not None:
+                transcript_to_genes[ensembl_ids[EAdapterFields.TRANSID]] = hgnc_id
+                proteins.append(
+                    Protein(protein_seq, gene_id=hgnc_id, transcript_id=ensembl_ids[EAdapterFields.TRANSID]))
+        epitopes = list(itertools.chain.from_iterable(generate_peptides_from_proteins(proteins, length)
+                                                      for length in range(args.peptide_min_length, args.peptide_max_length)))
 
     # read in allele list
     alleles = args.alleles
 
+    # protein IDs of the peptides mapped to their transcript IDs, shared by the output rows
+    transcript_ids = {}
+
     # predict bindings for all found neoepitopes
+    # generate_peptides_from_proteins already merges all occurrences of a sequence into one Peptide and
+    # peptides of different lengths cannot coincide, so every sequence is predicted exactly once
     if args.predict_bindings:
         result = EpitopePredictorFactory(args.method).predict(epitopes, alleles=alleles.split(';'))
 
+        # format all scores at once and collect the genes of every peptide only once
+        alleles = result.columns
+        scores = np.char.mod("%.3f", result.values.astype(float)).tolist()
+        peptide_genes = {}
+        for p in result.index.get_level_values(0):
+            if str(p) not in peptide_genes:
+                peptide_genes[str(p)] = set(
+                    transcript_to_genes[prot.transcript_id.split(":FRED2")[0]] for prot in p.get_all_proteins())
+
         with open(args.output, "w") as f:
-            alleles = result.columns
             var_column = " Variants" if args.vcf is not None else ""
             f.write("Sequence\tMethod\t" + "\t".join(a.name for a in alleles) + "\tAntigen ID\t" + var_column + "\n")
-            for index, row in result.iterrows():
-                p = index[0]
-                method = index[1]
-                proteins = ",".join(
-                    set([transcript_to_genes[prot.transcript_id.split(":FRED2")[0]] for prot in p.get_all_proteins()]))
-                vars_str = ""
-
+            writer = tsv_writer(f)
+            for (p, method), row_scores in zip(result.index, scores):
+                row = [str(p), method] + row_scores + [",".join(peptide_genes[str(p)])]
                 if args.vcf is not None:
-                    vars_str = "\t" + "|".join(set(prot_id.split(":FRED2")[0] + ":" + ",".join( repr(v) for v in set(p.get_variants_by_protein(prot_id)) )
-                    for prot_id in p.proteins.iterkeys()
-                        if p.get_variants_by_protein(prot_id)))
-
-                f.write(str(p) + "\t" + method + "\t" + "\t".join(
-                    "%.3f" % row[a] for a in alleles) + "\t" + proteins + vars_str + "\n")
+                    row.append(format_peptide_variants(p, transcript_ids))
+                writer.writerow(row)
 
         if args.etk:
             with open(args.output.rsplit(".", 1)[0] + "_etk.tsv", "w") as g:
-                alleles = result.columns
                 g.write("Alleles:\t" + "\t".join(a.name for a in alleles) + "\n")
-                for index, row in result.iterrows():
-                    p = index[0]
-                    proteins = " ".join(
-                        set([transcript_to_genes[prot.transcript_id.split(":FRED2")[0]] for prot in p.get_all_proteins()]))
-                    g.write(str(p) + "\t" + "\t".join("%.3f" % row[a] for a in alleles) + "\t" + proteins + "\n")
+                tsv_writer(g).writerows([str(p)] + row_scores + [" ".join(peptide_genes[str(p)])]
+                                        for p, row_scores in zip(result.index.get_level_values(0), scores))
     # don't predict bindings!
     # different output format!
     else:
+        def epitope_row(p):
+            row = [str(p), ",".join(
+                set([transcript_to_genes[prot.transcript_id.split(":FRED2")[0]] for prot in p.get_all_proteins()]))]
+            if args.vcf is not None:
+                row.append(format_peptide_variants(p, transcript_ids))
+            return row
+
         with open(args.output, "w") as f:
             var_column = " Variants" if args.vcf is not None else ""
             f.write("Sequence\tAntigen ID\t" + var_column + "\n")
-
-            for epitope in epitopes:
-                p = epitope
-                proteins = ",".join(
-                    set([transcript_to_genes[prot.transcript_id.split(":FRED2")[0]] for prot in p.get_all_proteins()]))
-                vars_str = ""
-
-                if args.vcf is not None:
-                    vars_str = "\t" + "|".join(set(prot_id.split(":FRED2")[0] + ":" + ",".join( repr(v) for v in set(p.get_variants_by_protein(prot_id)) )
-                    for prot_id in p.proteins.iterkeys()
-                        if p.get_variants_by_protein(prot_id)))
-
-                f.write(str(p) + "\t" + proteins + vars_str + "\n")
+            tsv_writer(f).writerows(epitope_row(p) for p in epitopes)
 
         with open(args.output.replace('.csv','.txt'), "w") as f:
-            for epitope in epitopes:
-                f.write(str(epitope) + "\n")
+            f.writelines(str(epitope) + "\n" for epitope in epitopes)
 
     return 0
 